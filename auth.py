@@ -1,35 +1,53 @@
-from passlib.context import CryptContext
-from datetime import datetime, timedelta
-from jose import jwt, JWTError
-
-SECRET_KEY = "your-secret-key"
+import bcrypt
+import jwt
+from jwt import InvalidTokenError
+from cachetools import TLRUCache
+from threading import Lock
+from dotenv import load_dotenv
+import os, time
+
+load_dotenv()
+SECRET_KEY = os.environ["JWT_SECRET"].encode("utf-8")  # Pre-encoded so PyJWT skips it per call
 ALGORITHM = "HS256"
 
-pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
+# Decoded payloads keyed by raw token, evicted once the token's own "exp" passes
+_JWT_CACHE_TTL = 900
+
+def _token_ttu(_token, payload, now):
+    return min(payload.get("exp", now + _JWT_CACHE_TTL), now + _JWT_CACHE_TTL)
+
+_jwt_cache = TLRUCache(maxsize=10_000, ttu=_token_ttu, timer=time.time)
+_jwt_cache_lock = Lock()
 
 def hash_password(password: str) -> str:
-    return pwd_context.hash(password)
+    return bcrypt.hashpw(password.encode(), bcrypt.gensalt(rounds=12)).decode()
 
 def verify_password(plain: str, hashed: str) -> bool:
-    return pwd_context.verify(plain, hashed)
+    return bcrypt.checkpw(plain.encode(), hashed.encode())
 
 def create_access_token(data: dict, expires_minutes=15):
     to_encode = data.copy()
-    expire = datetime.utcnow() + timedelta(minutes=expires_minutes)
-    to_encode.update({"exp": expire})
+    to_encode["exp"] = int(time.time()) + expires_minutes * 60
     return jwt.encode(to_encode, SECRET_KEY, algorithm=ALGORITHM)
 
 def create_refresh_token(data: dict):
     return jwt.encode(data, SECRET_KEY, algorithm=ALGORITHM)
 
-def decode_access_token(token: str):
+def _decode_cached(token: str):
+    with _jwt_cache_lock:
+        payload = _jwt_cache.get(token)
+    if payload is not None:
+        return payload
     try:
-        return jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
-    except JWTError:
-        return None
+        payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
+    except InvalidTokenError:
+        return None  # Invalid tokens are never cached
+    with _jwt_cache_lock:
+        _jwt_cache[token] = payload
+    return payload
+
+def decode_access_token(token: str):
+    return _decode_cached(token)
 
 def decode_token(token: str):
-    try:
-        return jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
-    except JWTError:
-        return None
+    return _decode_cached(token)
@@ -1,12 +1,20 @@
 from fastapi import FastAPI, HTTPException, Depends, Request, Body
-from fastapi.responses import JSONResponse
+from fastapi.responses import ORJSONResponse, StreamingResponse
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.security import OAuth2PasswordBearer, OAuth2PasswordRequestForm
+from fastapi.concurrency import run_in_threadpool
+from starlette.background import BackgroundTask
 
 from sqlmodel import SQLModel, Session, create_engine, select
+from sqlalchemy import event
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import selectinload
 from pydantic import BaseModel
 from dotenv import load_dotenv
-import os, httpx, time
+from enum import Enum
+import os, httpx, time, orjson
+from anyio import to_thread
+from contextlib import asynccontextmanager
 
 from auth import (
     hash_password, verify_password,
@@ -16,7 +24,68 @@ from auth import (
 from models import User, Conversation, Message
 
 load_dotenv()
-app = FastAPI()
+
+# ====== SQLite setup ======
+engine = create_engine(
+    "sqlite:///db.sqlite3",
+    echo=os.getenv("SQL_ECHO") == "1",  # Set SQL_ECHO=1 to log statements while debugging
+    connect_args={"check_same_thread": False, "timeout": 30},
+    pool_size=5,
+    max_overflow=10,
+    pool_pre_ping=True,
+)
+
+@event.listens_for(engine, "connect")
+def set_sqlite_pragmas(dbapi_connection, connection_record):
+    # WAL lets readers proceed while a write is in progress
+    cursor = dbapi_connection.cursor()
+    cursor.execute("PRAGMA journal_mode=WAL")
+    cursor.execute("PRAGMA synchronous=NORMAL")
+    cursor.execute("PRAGMA temp_store=MEMORY")
+    cursor.execute("PRAGMA mmap_size=268435456")
+    cursor.close()
+
+def ensure_indexes():
+    # create_all leaves existing tables alone, so older databases lack the model indexes
+    with engine.begin() as conn:
+        duplicates = conn.exec_driver_sql(
+            'SELECT COUNT(*) FROM (SELECT email FROM "user" GROUP BY email HAVING COUNT(*) > 1)'
+        ).scalar()
+        if duplicates:
+            raise RuntimeError(
+                f"{duplicates} email(s) belong to more than one user; "
+                "merge or remove those accounts before starting the server"
+            )
+        conn.exec_driver_sql('CREATE UNIQUE INDEX IF NOT EXISTS ix_user_email ON "user" (email)')
+        conn.exec_driver_sql("CREATE INDEX IF NOT EXISTS ix_conversation_user_id ON conversation (user_id)")
+        conn.exec_driver_sql("CREATE INDEX IF NOT EXISTS ix_message_conversation_id ON message (conversation_id)")
+
+def init_db():
+    SQLModel.metadata.create_all(engine)
+    ensure_indexes()
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Under `python main.py` the schema is prepared once before workers start; see __main__
+    if os.getenv("GENAI_DB_READY") != "1":
+        init_db()
+    # Open a pooled connection up front so the pragmas are applied before the first request
+    with engine.connect() as conn:
+        conn.exec_driver_sql("SELECT 1")
+    # Room for slow bcrypt calls without starving other blocking work
+    to_thread.current_default_thread_limiter().total_tokens = 64
+    # One keep-alive client per app so OpenRouter calls reuse TCP/TLS connections
+    app.state.httpx = httpx.AsyncClient(
+        timeout=httpx.Timeout(15.0, connect=5.0),
+        limits=httpx.Limits(max_connections=100, max_keepalive_connections=20),
+        http2=True,
+    )
+    try:
+        yield
+    finally:
+        await app.state.httpx.aclose()
+
+app = FastAPI(lifespan=lifespan, default_response_class=ORJSONResponse)
 
 # ====== CORS for frontend ======
 app.add_middleware(
@@ -27,25 +96,29 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
-# ====== SQLite setup ======
-engine = create_engine("sqlite:///db.sqlite3", echo=True)
-
-@app.on_event("startup")
-def init_db():
-    SQLModel.metadata.create_all(engine)
-
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="login")
 
-def get_current_user(token: str = Depends(oauth2_scheme)):
-    payload = decode_access_token(token)
-    if not payload:
-        raise HTTPException(status_code=401, detail="Invalid or expired token")
-    return payload["sub"]  # Returns user's email
+class CurrentUserBearer(OAuth2PasswordBearer):
+    # Reads and decodes the bearer token in one dependency; FastAPI still documents it as OAuth2
+    async def __call__(self, request: Request) -> str:
+        token = await super().__call__(request)  # 401 "Not authenticated" if missing
+        payload = decode_access_token(token)
+        if not payload:
+            raise HTTPException(status_code=401, detail="Invalid or expired token")
+        return payload["sub"]  # Returns user's email
+
+get_current_user = CurrentUserBearer(tokenUrl="login", scheme_name="OAuth2PasswordBearer")
 
 # ----------- MODELS / SCHEMAS -----------
+class Persona(str, Enum):
+    friendly = "friendly"
+    sarcastic = "sarcastic"
+    dev = "dev"
+    translator = "translator"
+
 class PromptRequest(BaseModel):
     prompt: str
-    persona: str
+    persona: Persona = Persona.friendly
 
 # ============== API ROUTES ==============
 
@@ -64,7 +137,11 @@ def get_users():
 def create_user(user: User):
     with Session(engine) as session:
         session.add(user)
-        session.commit()
+        try:
+            session.commit()
+        except IntegrityError:
+            session.rollback()
+            raise HTTPException(status_code=400, detail="User already exists")
         session.refresh(user)
         return {"msg": "User added", "user": user}
 
@@ -85,7 +162,11 @@ def update_user(user_id: int, updated_user: User):
         user.name = updated_user.name
         user.email = updated_user.email
         session.add(user)
-        session.commit()
+        try:
+            session.commit()
+        except IntegrityError:
+            session.rollback()
+            raise HTTPException(status_code=400, detail="Email already in use")
         session.refresh(user)
         return {"msg": "User updated", "user": user}
 
@@ -100,38 +181,48 @@ def delete_user(user_id: int):
         return {"msg": "User deleted"}
 
 # ----------- Auth (Signup/Login/Refresh/Logout) -----------
-@app.post("/signup")
-def signup(user: User):
+def _register_user(user: User):
+    # Blocking (bcrypt + SQLite); run via run_in_threadpool
+    user.password = hash_password(user.password)
     with Session(engine) as session:
-        existing_user = session.exec(select(User).where(User.email == user.email)).first()
-        if existing_user:
-            raise HTTPException(status_code=400, detail="User already exists")
-        user.password = hash_password(user.password)
         session.add(user)
-        session.commit()
-        session.refresh(user)
-        return {"msg": "User registered!"}
+        try:
+            session.commit()
+        except IntegrityError:
+            # Unique index on email rejects duplicates, even under concurrent signups
+            session.rollback()
+            raise HTTPException(status_code=400, detail="User already exists")
 
-@app.post("/login")
-def login(form_data: OAuth2PasswordRequestForm = Depends()):
+def _authenticate_user(email: str, password: str) -> str:
+    # Blocking (SQLite + bcrypt); run via run_in_threadpool
     with Session(engine) as session:
-        user = session.exec(select(User).where(User.email == form_data.username)).first()
-        if not user:
-            raise HTTPException(status_code=401, detail="User not found")
-        if not verify_password(form_data.password, user.password):
-            raise HTTPException(status_code=401, detail="Incorrect password")
-        access_token = create_access_token(data={"sub": user.email}, expires_minutes=15)
-        refresh_token = create_refresh_token(data={"sub": user.email})
-        response = JSONResponse(content={"access_token": access_token, "token_type": "bearer"})
-        response.set_cookie(
-            key="refresh_token",
-            value=refresh_token,
-            httponly=True,
-            secure=False,
-            samesite="strict",
-            max_age=7 * 24 * 60 * 60
-        )
-        return response
+        user = session.exec(select(User).where(User.email == email)).first()
+    if not user:
+        raise HTTPException(status_code=401, detail="User not found")
+    if not verify_password(password, user.password):
+        raise HTTPException(status_code=401, detail="Incorrect password")
+    return user.email
+
+@app.post("/signup")
+async def signup(user: User):
+    await run_in_threadpool(_register_user, user)
+    return {"msg": "User registered!"}
+
+@app.post("/login")
+async def login(form_data: OAuth2PasswordRequestForm = Depends()):
+    email = await run_in_threadpool(_authenticate_user, form_data.username, form_data.password)
+    access_token = create_access_token(data={"sub": email}, expires_minutes=15)
+    refresh_token = create_refresh_token(data={"sub": email})
+    response = ORJSONResponse(content={"access_token": access_token, "token_type": "bearer"})
+    response.set_cookie(
+        key="refresh_token",
+        value=refresh_token,
+        httponly=True,
+        secure=False,
+        samesite="strict",
+        max_age=7 * 24 * 60 * 60
+    )
+    return response
 
 @app.post("/refresh")
 def refresh_token(request: Request):
@@ -149,7 +240,7 @@ def root():
 
 @app.get("/logout")
 def logout():
-    response = JSONResponse(content={"msg": "Logged out"})
+    response = ORJSONResponse(content={"msg": "Logged out"})
     response.delete_cookie("refresh_token")
     return response
 
@@ -160,46 +251,102 @@ def protected_profile(current_user: str = Depends(get_current_user)):
 # ------------ AI Generate (OpenRouter) -----------
 OPENROUTER_API_KEY = os.getenv("OPENROUTER_API_KEY")
 OPENROUTER_API_URL = "https://openrouter.ai/api/v1/chat/completions"
+_OR_HEADERS = {
+    "Authorization": f"Bearer {OPENROUTER_API_KEY}",
+    "HTTP-Referer": "http://localhost:8000",
+    "Content-Type": "application/json"
+}
+
+def _sse_event(data: dict) -> bytes:
+    return b"data: " + orjson.dumps(data) + b"\n\n"
+
+def _delta_content(chunk: dict):
+    # Text carried by one OpenRouter stream chunk; ValueError if the chunk has an unexpected shape
+    choices = chunk.get("choices")
+    if not choices:
+        return None
+    if not isinstance(choices, list) or not isinstance(choices[0], dict):
+        raise ValueError("unexpected choices")
+    delta = choices[0].get("delta") or {}  # Final chunks may carry "delta": null
+    if not isinstance(delta, dict):
+        raise ValueError("unexpected delta")
+    content = delta.get("content")
+    if content is not None and not isinstance(content, str):
+        raise ValueError("unexpected content")
+    return content
+
+_SYSTEM_PROMPTS: dict[Persona, str] = {
+    Persona.friendly: "You are a friendly and helpful assistant. Speak casually and warmly.",
+    Persona.sarcastic: "You're a sarcastic, witty assistant who never misses a chance to roast.",
+    Persona.dev: "You are DevGPT, a skilled AI engineer who explains code precisely.",
+    Persona.translator: "You are a multilingual translator. Translate input accurately."
+}
 
 @app.post("/generate-text")
 async def generate_text(request: PromptRequest, current_user: str = Depends(get_current_user)):
     if not OPENROUTER_API_KEY:
         raise HTTPException(status_code=500, detail="Missing OpenRouter API key")
 
-    system_prompts = {
-        "friendly": "You are a friendly and helpful assistant. Speak casually and warmly.",
-        "sarcastic": "You're a sarcastic, witty assistant who never misses a chance to roast.",
-        "dev": "You are DevGPT, a skilled AI engineer who explains code precisely.",
-        "translator": "You are a multilingual translator. Translate input accurately."
-    }
-    system_prompt = system_prompts.get(request.persona, system_prompts["friendly"])
+    system_prompt = _SYSTEM_PROMPTS[request.persona]
     payload = {
         "model": "openai/gpt-3.5-turbo",
         "messages": [
             {"role": "system", "content": system_prompt},
             {"role": "user", "content": request.prompt}
-        ]
-    }
-    headers = {
-        "Authorization": f"Bearer {OPENROUTER_API_KEY}",
-        "HTTP-Referer": "http://localhost:8000",
-        "Content-Type": "application/json"
+        ],
+        "stream": True
     }
+    client = app.state.httpx
+    start = time.time()
     try:
-        start = time.time()
-        async with httpx.AsyncClient(timeout=httpx.Timeout(15.0, connect=5.0)) as client:
-            response = await client.post(OPENROUTER_API_URL, headers=headers, json=payload)
-        result = response.json()
-        if "choices" in result and result["choices"]:
-            return {
-                "response": result["choices"][0]["message"]["content"].strip(),
-                "duration": round(time.time() - start, 2)
-            }
-        raise HTTPException(status_code=500, detail="Invalid response from OpenRouter")
+        response = await client.send(
+            client.build_request("POST", OPENROUTER_API_URL, headers=_OR_HEADERS, json=payload),
+            stream=True,
+        )
     except httpx.RequestError as e:
         raise HTTPException(status_code=502, detail=f"Request error: {str(e)}")
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=f"GenAI Error: {str(e)}")
+    if response.status_code != 200:
+        await response.aclose()
+        raise HTTPException(status_code=500, detail="Invalid response from OpenRouter")
+
+    async def stream_completion():
+        # Forwards each delta as its own SSE event, then a final event with the duration
+        try:
+            async for line in response.aiter_lines():
+                if not line.startswith("data:"):
+                    continue  # Blank separators and ": OPENROUTER PROCESSING" keep-alives
+                data = line[len("data:"):].strip()
+                if data == "[DONE]":
+                    break
+                try:
+                    chunk = orjson.loads(data)  # orjson.JSONDecodeError is a ValueError
+                    if not isinstance(chunk, dict):
+                        raise ValueError("chunk is not an object")
+                    content = None if "error" in chunk else _delta_content(chunk)
+                except ValueError:
+                    yield _sse_event({"error": "GenAI Error: malformed chunk from OpenRouter"})
+                    return
+                if "error" in chunk:
+                    # OpenRouter reports mid-stream failures as a chunk without choices
+                    error = chunk["error"]
+                    message = error.get("message", error) if isinstance(error, dict) else error
+                    yield _sse_event({"error": f"GenAI Error: {message}"})
+                    return
+                if content:
+                    yield _sse_event({"content": content})
+            yield _sse_event({"duration": round(time.time() - start, 2)})
+        except httpx.HTTPError as e:
+            yield _sse_event({"error": f"GenAI Error: {str(e)}"})
+        finally:
+            await response.aclose()
+
+    # The background task also releases the upstream connection if the client leaves before
+    # the generator ever runs (its finally block would not execute then)
+    return StreamingResponse(
+        stream_completion(),
+        media_type="text/event-stream",
+        background=BackgroundTask(response.aclose),
+    )
 
 # ------------ Conversations & Messages -----------
 @app.post("/save-conversation")
@@ -207,30 +354,46 @@ def save_conversation(data: dict = Body(...), user=Depends(get_current_user)):
     with Session(engine) as session:
         convo = Conversation(title=data["title"], user_id=user)
         session.add(convo)
-        session.commit()
-        session.refresh(convo)
-        for msg in data["messages"]:
-            m = Message(content=msg["content"], role=msg["role"], conversation_id=convo.id)
-            session.add(m)
+        session.flush()  # Assigns convo.id without committing
+        session.add_all([
+            Message(content=msg["content"], role=msg["role"], conversation_id=convo.id)
+            for msg in data["messages"]
+        ])
         session.commit()
     return {"msg": "Conversation saved"}
 
 @app.get("/conversations")
 def get_conversations(user=Depends(get_current_user)):
     with Session(engine) as session:
-        convos = session.exec(select(Conversation).where(Conversation.user_id == user)).all()
-        result = []
-        for convo in convos:
-            messages = session.exec(select(Message).where(Message.conversation_id == convo.id)).all()
-            result.append({
+        convos = session.exec(
+            select(Conversation)
+            .where(Conversation.user_id == user)
+            .options(selectinload(Conversation.messages))
+        ).all()
+        return [
+            {
                 "id": convo.id,
                 "title": convo.title,
                 "created_at": convo.created_at,
-                "messages": [{"role": m.role, "content": m.content} for m in messages]
-            })
-        return result
+                "messages": [{"role": m.role, "content": m.content} for m in convo.messages]
+            }
+            for convo in convos
+        ]
 
 if __name__ == "__main__":
     import uvicorn
-    uvicorn.run(app, host="0.0.0.0", port=8000)
+    # Every worker runs lifespan, so create the schema here once instead of racing on it
+    init_db()
+    os.environ["GENAI_DB_READY"] = "1"  # Inherited by the worker processes
+    # "auto" picks uvloop where it is installed (it has no Windows build)
+    uvicorn.run(
+        "main:app",
+        host="0.0.0.0",
+        port=8000,
+        loop="auto",
+        http="httptools",
+        workers=os.cpu_count(),
+        log_level="warning",
+        access_log=False,
+    )
 
@@ -5,7 +5,7 @@ from datetime import datetime
 class User(SQLModel, table=True):
     id: Optional[int] = Field(default=None, primary_key=True)
     name: str
-    email: str
+    email: str = Field(index=True, unique=True)
     password: str
 
 from typing import Optional, List
@@ -15,7 +15,7 @@ from datetime import datetime
 class Conversation(SQLModel, table=True):
     id: Optional[int] = Field(default=None, primary_key=True)
     title: str
-    user_id: str  # Email is fine if you're using it as ID
+    user_id: str = Field(index=True)  # Email is fine if you're using it as ID
     created_at: datetime = Field(default_factory=datetime.utcnow)
 
     messages: List["Message"] = Relationship(back_populates="conversation")
@@ -25,6 +25,6 @@ class Message(SQLModel, table=True):
     id: Optional[int] = Field(default=None, primary_key=True)
     content: str
     role: str
-    conversation_id: int = Field(foreign_key="conversation.id")
+    conversation_id: int = Field(foreign_key="conversation.id", index=True)
 
     conversation: Optional[Conversation] = Relationship(back_populates="messages")